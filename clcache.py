@@ -27,20 +27,257 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
-from filelock import FileLock
+from filelock import FileLock, FileLockException
+import errno
+from functools import partial
 import hashlib
 import json
+import mmap
+from operator import itemgetter
 import os
+import re
 from shutil import copyfile, rmtree
 import subprocess
 from subprocess import Popen, PIPE, STDOUT
 import sys
-import codecs
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DEVNULL = open(os.devnull, 'wb')
+
+def newHash():
+    # SHA-1 is the default since it is available everywhere; the faster
+    # alternatives need the pyblake2 or the xxhash module.
+    algorithm = os.environ.get("CLCACHE_HASH", "sha1")
+    if algorithm == "blake2b" and blake2b:
+        return blake2b(digest_size=20)
+    if algorithm == "xxh128" and xxhash and hasattr(xxhash, "xxh128"):
+        return xxhash.xxh128()
+    if algorithm != "sha1":
+        printTraceStatement("Hash algorithm '%s' is not available, using sha1"
+                            % algorithm)
+    return hashlib.sha1()
+
+def ensureDirectoryExists(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def replaceFile(src, dst):
+    # Python 2 has no os.replace(), and os.rename() refuses to overwrite an
+    # existing file on Windows.
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    elif sys.platform == "win32":
+        import ctypes
+        MOVEFILE_REPLACE_EXISTING = 0x1
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst),
+                                                  MOVEFILE_REPLACE_EXISTING):
+            raise ctypes.WinError()
+    else:
+        os.rename(src, dst)
+
+def tryReplaceFile(src, dst):
+    # On Windows, replacing a file fails while another process has it open.
+    # The files replaced this way only hold data which can be recomputed, so
+    # give up after a few attempts rather than failing the compile.
+    for attempt in range(5):
+        try:
+            replaceFile(src, dst)
+            return True
+        except OSError:
+            time.sleep(0.01)
+    try:
+        os.remove(src)
+    except OSError:
+        pass
+    return False
+
+def hardLink(src, dst):
+    # Python 2 has no os.link() on Windows.
+    if hasattr(os, "link"):
+        os.link(src, dst)
+    elif sys.platform == "win32":
+        import ctypes
+        if not ctypes.windll.kernel32.CreateHardLinkW(unicode(dst), unicode(src),
+                                                      None):
+            raise ctypes.WinError()
+    else:
+        raise OSError(errno.ENOSYS, "Hard links are not supported")
+
+def copyOrLink(src, dst):
+    # Hard links avoid copying the object file; fall back to copying if the
+    # file system doesn't support them or the files are on different volumes.
+    if os.environ.get("CLCACHE_HARDLINK") != "0":
+        try:
+            if os.path.exists(dst):
+                os.remove(dst)
+            hardLink(src, dst)
+            return
+        except OSError:
+            pass
+    copyfile(src, dst)
 
-def cacheLock(cache):
-    lock = FileLock("x", timeout=2)
-    lock.lockfile = os.path.join(cache.cacheDirectory(), "cache.lock")
-    return lock
+def appendToLog(fileName, line):
+    with open(fileName, 'ab') as f:
+        f.write(line + '\n')
+
+def logSize(fileName):
+    try:
+        return os.path.getsize(fileName)
+    except OSError:
+        return 0
+
+def takeLog(fileName):
+    # Move the log out of the way before reading it so that lines appended
+    # concurrently end up in a fresh log instead of getting lost.
+    takenFileName = "%s.%d" % (fileName, os.getpid())
+    try:
+        os.rename(fileName, takenFileName)
+    except OSError:
+        return []
+    with open(takenFileName, 'rb') as f:
+        lines = f.read().splitlines()
+    os.remove(takenFileName)
+    return lines
+
+# The size beyond which the hit log and the index log get folded into the
+# statistics and the cache index even if the cache needs no cleaning.
+maximumLogSize = 1024 * 1024
+
+def processExists(pid):
+    if sys.platform == "win32":
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        ERROR_ACCESS_DENIED = 5
+        STILL_ACTIVE = 259
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False,
+                                      pid)
+        if not handle:
+            return ctypes.GetLastError() == ERROR_ACCESS_DENIED
+        try:
+            exitCode = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exitCode)):
+                return True
+            return exitCode.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class CacheLock(FileLock):
+    """ The lock serializing cleaning the cache. The lock file records the
+        pid of its holder so that a lock left behind by a process which died
+        while holding it can be told apart from one held by a process which
+        is still busy.
+    """
+
+    def __init__(self, cache, timeout):
+        FileLock.__init__(self, "x", timeout=timeout)
+        self.lockfile = os.path.join(cache.cacheDirectory(), "cache.lock")
+
+    def acquire(self):
+        try:
+            FileLock.acquire(self)
+        except FileLockException:
+            if not self._breakAbandonedLock():
+                raise
+            FileLock.acquire(self)
+        os.write(self.fd, str(os.getpid()))
+
+    def release(self):
+        if self.is_locked:
+            os.close(self.fd)
+            self.is_locked = False
+            # Never remove a lock which some other process holds now.
+            if self._holder(self.lockfile) == os.getpid():
+                try:
+                    os.unlink(self.lockfile)
+                except OSError:
+                    pass
+
+    def _holder(self, fileName):
+        try:
+            with open(fileName, 'rb') as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def _breakAbandonedLock(self):
+        holder = self._holder(self.lockfile)
+        if holder is None:
+            # The holder might not have written its pid yet; only consider
+            # the lock abandoned if it never did.
+            try:
+                if time.time() - os.path.getmtime(self.lockfile) < 60:
+                    return False
+            except OSError:
+                return True
+        elif processExists(holder):
+            return False
+
+        # Move the lock file out of the way before removing it, and make sure
+        # that it is still the abandoned one: another process might have
+        # broken the lock and acquired it in the meantime.
+        staleLockFile = "%s.%d" % (self.lockfile, os.getpid())
+        try:
+            os.rename(self.lockfile, staleLockFile)
+        except OSError:
+            return True
+        if self._holder(staleLockFile) != holder:
+            # Put it back unless yet another process got the lock since.
+            try:
+                if hasattr(os, "link"):
+                    os.link(staleLockFile, self.lockfile)
+                else:
+                    os.rename(staleLockFile, self.lockfile)
+            except OSError:
+                pass
+            if os.path.exists(staleLockFile):
+                os.remove(staleLockFile)
+            return False
+        os.remove(staleLockFile)
+        return True
+
+def globalCacheLock(cache, timeout=2):
+    return CacheLock(cache, timeout)
+
+# Remove all arguments from the command line which only influence the
+# preprocessor; the preprocessor's output is already included into the hash
+# sum so we don't have to care about these switches in the command line as
+# well.
+#
+# Also remove the switch for specifying the output file name (Fo); we don't
+# want two invocations which are identical except for the output file name to
+# be treated differently.
+_argsToStripRegex = re.compile(r'[/-](AI|C|E|P|FI|u|X|FU|D|EP|Fx|U|I|Fo)')
 
 class ObjectCache:
     def __init__(self):
@@ -59,51 +296,207 @@ class ObjectCache:
         if currentSize < maximumSize:
             return
 
-        objects = [os.path.join(root, "object")
-                   for root, folder, files in os.walk(self.dir)
-                   if "object" in files]
+        index = self._loadIndex(stats.foldCacheHits())
+
+        # Concurrent invocations may lose each other's updates of the cache
+        # size statistic; the index knows the exact size of every entry.
+        currentSize = sum(size for size, atime, hits in index.itervalues())
 
-        objectInfos = [(os.stat(fn), fn) for fn in objects]
-        objectInfos.sort(key=lambda t: t[0].st_atime, reverse=True)
+        # Evict the entries with the lowest hit rate since their last access
+        # first so that entries which are used often survive a full rebuild
+        # touching every other entry once. Counting the initial store as a hit
+        # keeps fresh entries around and evicts unused ones in LRU order.
+        now = time.time()
+        objectInfos = [((hits + 1) / (now - atime + 1), size, key)
+                       for key, (size, atime, hits) in index.iteritems()]
+        objectInfos.sort(key=itemgetter(0))
 
-        for stat, fn in objectInfos:
-            rmtree(os.path.split(fn)[0])
-            currentSize -= stat.st_size
+        victims = []
+        for score, size, key in objectInfos:
             if currentSize < maximumSize:
                 break
+            victims.append(self._cacheEntryDir(key))
+            del index[key]
+            currentSize -= size
 
+        self._removeEntryDirs(victims)
+        self._saveIndex(index)
         stats.setCacheSize(currentSize)
 
-    def computeKey(self, compilerBinary, commandLine):
-        ppcmd = [compilerBinary, "/EP"]
-        ppcmd += [arg for arg in commandLine[1:] if not arg in ("-c", "/c")]
-        preprocessor = Popen(ppcmd, stdout=PIPE, stderr=open(os.devnull, 'w'))
-        preprocessedSourceCode = preprocessor.communicate()[0]
+    def _removeEntryDirs(self, entryDirs):
+        removeEntryDir = partial(rmtree, ignore_errors=True)
+        # Removing files is I/O bound, so a few threads speed up evicting many
+        # entries; for just a few of them, starting the threads isn't worth it.
+        if len(entryDirs) < 4:
+            for entryDir in entryDirs:
+                removeEntryDir(entryDir)
+            return
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(8, len(entryDirs)))
+        try:
+            pool.map(removeEntryDir, entryDirs)
+        finally:
+            pool.close()
+            pool.join()
+
+    def indexLogSize(self):
+        return logSize(self._indexLogName())
+
+    def updateIndex(self, hits):
+        self._saveIndex(self._loadIndex(hits))
 
+    def _loadIndex(self, hits):
+        # The index maps each cache key to the size, the last access time and
+        # the number of hits of the cached object; entries added since the
+        # index was last saved are recorded in a log by setEntry().
+        try:
+            with open(self._indexFileName(), 'rb') as f:
+                index = pickle.load(f)
+        except:
+            index = self._scanIndex()
+
+        for key, value in index.items():
+            if len(value) == 2:
+                # Index written by an older version without hit counts.
+                index[key] = value + (0,)
+
+        for line in takeLog(self._indexLogName()):
+            # The log is appended to without locking, so skip lines which were
+            # cut short or interleaved with others.
+            fields = line.split()
+            if len(fields) != 3:
+                continue
+            try:
+                index[fields[0]] = (int(fields[1]), float(fields[2]), 0)
+            except ValueError:
+                continue
+
+        for key, atime in hits:
+            if key in index:
+                size, lastAccess, numHits = index[key]
+                index[key] = (size, max(lastAccess, atime), numHits + 1)
+
+        return index
+
+    def _scanIndex(self):
+        index = {}
+        for entryDir, stat in self._scanObjects(self.dir):
+            index[os.path.basename(entryDir)] = (stat.st_size, stat.st_atime, 0)
+        return index
+
+    def _scanObjects(self, dir):
+        # Yields the directory and the stat result of every cached object.
+        # On Windows, scandir() gets the stat results from the directory
+        # listing itself instead of needing a system call per object.
+        if scandir is None:
+            for root, folder, files in os.walk(dir):
+                if "object" in files:
+                    yield root, os.stat(os.path.join(root, "object"))
+            return
+
+        for entry in scandir(dir):
+            if entry.is_dir(follow_symlinks=False):
+                for result in self._scanObjects(entry.path):
+                    yield result
+            elif entry.name == "object":
+                yield dir, entry.stat(follow_symlinks=False)
+
+    def _saveIndex(self, index):
+        tempFileName = "%s.%d" % (self._indexFileName(), os.getpid())
+        with open(tempFileName, 'wb') as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        tryReplaceFile(tempFileName, self._indexFileName())
+
+    def _indexFileName(self):
+        return os.path.join(self.dir, "lru.pkl")
+
+    def _indexLogName(self):
+        return os.path.join(self.dir, "lru.log")
+
+    def computeKey(self, compilerBinary, commandLine, preprocessedSourceFile):
+        # The preprocessed source code is written to preprocessedSourceFile so
+        # that a cache miss can compile it without preprocessing again.
+        # Returns the key and whether the compiler accepts the preprocessed
+        # source code, or (None, False) if the source file could not be
+        # preprocessed.
         normalizedCmdLine = self._normalizedCommandLine(commandLine[1:])
 
         stat = os.stat(compilerBinary)
-        sha = hashlib.sha1()
+        sha = newHash()
         sha.update(str(stat.st_mtime))
         sha.update(str(stat.st_size))
         sha.update(' '.join(normalizedCmdLine))
-        sha.update(preprocessedSourceCode)
-        return sha.hexdigest()
+
+        ppcmd = [compilerBinary, "/P", "/Fi" + preprocessedSourceFile]
+        ppcmd += [arg for arg in commandLine[1:] if not arg in ("-c", "/c")]
+        if subprocess.call(ppcmd, stdout=DEVNULL, stderr=DEVNULL) != 0:
+            return None, False
+
+        # Feed the preprocessed source code into the hash sum piecewise instead
+        # of reading the complete (possibly huge) translation unit first. The
+        # #line directives are skipped since they contain absolute paths;
+        # otherwise identical code in different directories would never share
+        # cache entries.
+        # The compiler handles #import directives itself, and it rejects the
+        # preprocessed source code containing them. Looking for the directive
+        # anywhere in a line is cheaper than parsing it; a false positive only
+        # means that the original source file gets compiled.
+        compilable = True
+        with open(preprocessedSourceFile, 'rb') as f:
+            for line in f:
+                if not line.startswith("#line"):
+                    sha.update(line)
+                    if "#import" in line:
+                        compilable = False
+        return sha.hexdigest(), compilable
 
     def hasEntry(self, key):
         return os.path.exists(self.cachedObjectName(key))
 
     def setEntry(self, key, objectFileName, compilerOutput):
-        if not os.path.exists(self._cacheEntryDir(key)):
-            os.makedirs(self._cacheEntryDir(key))
-        copyfile(objectFileName, self.cachedObjectName(key))
-        open(self._cachedCompilerOutputName(key), 'w').write(compilerOutput)
+        # Assemble the entry in a private directory and rename that into place
+        # so that hasEntry() never sees a partially written entry. Returns
+        # False if the entry was stored by a concurrent invocation already.
+        entryDir = self._cacheEntryDir(key)
+        tempEntryDir = "%s.tmp.%d" % (entryDir, os.getpid())
+        ensureDirectoryExists(tempEntryDir)
+        copyOrLink(objectFileName, os.path.join(tempEntryDir, "object"))
+        with open(os.path.join(tempEntryDir, "output.txt"), 'wb') as f:
+            f.write(compilerOutput)
+
+        if os.path.exists(entryDir) and not self.hasEntry(key):
+            # Left behind by an invocation which didn't store atomically yet.
+            rmtree(entryDir, ignore_errors=True)
+        try:
+            os.rename(tempEntryDir, entryDir)
+        except OSError:
+            rmtree(tempEntryDir, ignore_errors=True)
+            return False
+
+        appendToLog(self._indexLogName(), "%s %d %f" % (
+            key, os.path.getsize(objectFileName), time.time()))
+        return True
 
     def cachedObjectName(self, key):
         return os.path.join(self._cacheEntryDir(key), "object")
 
-    def cachedCompilerOutput(self, key):
-        return open(self._cachedCompilerOutputName(key), 'r').read()
+    def printCachedCompilerOutput(self, key):
+        # Write the output straight from a memory mapping of the file instead
+        # of reading it into a string first; empty files cannot be mapped.
+        with open(self._cachedCompilerOutputName(key), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            output = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                getattr(sys.stdout, "buffer", sys.stdout).write(output)
+            finally:
+                output.close()
+
+    def temporaryDirectory(self):
+        tempDir = os.path.join(self.dir, "tmp", str(os.getpid()))
+        ensureDirectoryExists(tempDir)
+        return tempDir
 
     def _cacheEntryDir(self, key):
         return os.path.join(self.dir, key[:2], key)
@@ -112,38 +505,57 @@ class ObjectCache:
         return os.path.join(self._cacheEntryDir(key), "output.txt")
 
     def _normalizedCommandLine(self, cmdline):
-        # Remove all arguments from the command line which only influence the
-        # preprocessor; the preprocessor's output is already included into the
-        # hash sum so we don't have to care about these switches in the
-        # command line as well.
-        _argsToStrip = ("AI", "C", "E", "P", "FI", "u", "X",
-                        "FU", "D", "EP", "Fx", "U", "I")
-
-        # Also remove the switch for specifying the output file name; we don't
-        # want two invocations which are identical except for the output file
-        # name to be treated differently.
-        _argsToStrip += ("Fo",)
-
-        return [arg for arg in cmdline
-                if not (arg[0] in "/-" and arg[1:].startswith(_argsToStrip))]
-
-class PersistentJSONDict:
+        return [arg for arg in cmdline if not _argsToStripRegex.match(arg)]
+
+class PersistentStore:
     def __init__(self, fileName):
         self._dirty = False
-        self._dict = {}
+        self._sections = {}
         self._fileName = fileName
         try:
-            self._dict = json.load(open(self._fileName, 'r'))
+            with open(self._fileName, 'rb') as f:
+                self._sections = pickle.load(f)
         except:
             pass
 
+    def section(self, name, legacyFileName=None):
+        if not name in self._sections:
+            self._sections[name] = self._loadLegacySection(legacyFileName)
+            self._dirty = True
+        return StoreSection(self, self._sections[name])
+
+    def markDirty(self):
+        self._dirty = True
+
     def save(self):
         if self._dirty:
-            json.dump(self._dict, open(self._fileName, 'w'))
+            # Write to a private file first and move it into place so that
+            # concurrent invocations never see a partially written store.
+            tempFileName = "%s.%d" % (self._fileName, os.getpid())
+            with open(tempFileName, 'wb') as f:
+                pickle.dump(self._sections, f, pickle.HIGHEST_PROTOCOL)
+            tryReplaceFile(tempFileName, self._fileName)
+
+    def _loadLegacySection(self, fileName):
+        # Older clcache versions kept each section in a JSON file of its own;
+        # pick it up once so that the data is carried over.
+        if fileName:
+            try:
+                with open(fileName, 'r') as f:
+                    return json.load(f)
+            except (IOError, ValueError):
+                pass
+        return {}
+
+
+class StoreSection:
+    def __init__(self, store, sectionDict):
+        self._store = store
+        self._dict = sectionDict
 
     def __setitem__(self, key, value):
         self._dict[key] = value
-        self._dirty = True
+        self._store.markDirty()
 
     def __getitem__(self, key):
         return self._dict[key]
@@ -155,9 +567,10 @@ class PersistentJSONDict:
 class Configuration:
     _defaultValues = { "MaximumCacheSize": 1024 * 1024 * 1000 }
 
-    def __init__(self, objectCache):
-        self._cfg = PersistentJSONDict(os.path.join(objectCache.cacheDirectory(),
-                                                    "config.txt"))
+    def __init__(self, objectCache, store):
+        cacheDir = objectCache.cacheDirectory()
+        self._cfg = store.section("config",
+                                  os.path.join(cacheDir, "config.txt"))
         for setting, defaultValue in self._defaultValues.iteritems():
             if not setting in self._cfg:
                 self._cfg[setting] = defaultValue
@@ -168,14 +581,13 @@ class Configuration:
     def setMaximumCacheSize(self, size):
         self._cfg["MaximumCacheSize"] = size
 
-    def save(self):
-        self._cfg.save()
-
 
 class CacheStatistics:
-    def __init__(self, objectCache):
-        self._stats = PersistentJSONDict(os.path.join(objectCache.cacheDirectory(),
-                                                      "stats.txt"))
+    def __init__(self, objectCache, store):
+        cacheDir = objectCache.cacheDirectory()
+        self._stats = store.section("stats",
+                                    os.path.join(cacheDir, "stats.txt"))
+        self._hitLogName = os.path.join(cacheDir, "hits.log")
         for k in ["CallsWithoutSourceFile",
                   "CallsWithMultipleSourceFiles",
                   "CallsForLinking",
@@ -218,8 +630,29 @@ class CacheStatistics:
     def numCacheHits(self):
         return self._stats["CacheHits"]
 
-    def registerCacheHit(self):
-        self._stats["CacheHits"] += 1
+    def registerCacheHitFast(self, key):
+        # Cache hits are recorded by appending a line to a log file instead of
+        # rewriting the state file; foldCacheHits() accounts for them later.
+        appendToLog(self._hitLogName, "%s %f" % (key, time.time()))
+
+    def hitLogSize(self):
+        return logSize(self._hitLogName)
+
+    def foldCacheHits(self):
+        # Returns the (key, access time) pairs of the folded hits so that the
+        # cache index can be updated accordingly.
+        lines = takeLog(self._hitLogName)
+        self._stats["CacheHits"] += len(lines)
+        hits = []
+        for line in lines:
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            try:
+                hits.append((fields[0], float(fields[1])))
+            except ValueError:
+                continue
+        return hits
 
     def numCacheMisses(self):
         return self._stats["CacheMisses"]
@@ -227,21 +660,42 @@ class CacheStatistics:
     def registerCacheMiss(self):
         self._stats["CacheMisses"] += 1
 
-    def save(self):
-        self._stats.save()
-
 class AnalysisResult:
     Ok, NoSourceFile, MultipleSourceFiles, CalledForLink = range(4)
 
-def findCompilerBinary():
+def fileExists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+def findCompilerBinary(cache):
     try:
         path = os.environ["CLCACHE_CL"]
         if os.path.exists(path):
             return path
     except KeyError:
-        for dir in os.environ["PATH"].split(os.pathsep):
+        # Searching the PATH takes a stat() call per directory, so remember
+        # where cl.exe was found for the current PATH.
+        searchPath = os.environ["PATH"]
+        searchPathHash = hashlib.sha1(searchPath).hexdigest()
+        memoFileName = os.path.join(cache.cacheDirectory(), "compiler.cache")
+        try:
+            with open(memoFileName, 'r') as f:
+                memoSearchPathHash, path = f.read().split('\n', 1)
+            if memoSearchPathHash == searchPathHash and fileExists(path):
+                return path
+        except (IOError, ValueError):
+            pass
+
+        for dir in searchPath.split(os.pathsep):
             path = os.path.join(dir, "cl.exe")
-            if os.path.exists(path):
+            if fileExists(path):
+                tempFileName = "%s.%d" % (memoFileName, os.getpid())
+                with open(tempFileName, 'w') as f:
+                    f.write(searchPathHash + '\n' + path)
+                tryReplaceFile(tempFileName, memoFileName)
                 return path
     return None
 
@@ -250,37 +704,68 @@ def printTraceStatement(msg):
     if "CLCACHE_LOG" in os.environ:
         print "*** clcache.py: " + msg
 
+class ResponseFileCycleError(Exception):
+    pass
+
 def expandCommandLine(cmdline):
     ret = []
 
-    for arg in cmdline:
-        if arg[0] == '@':
+    # Arguments still to be processed, in reverse order so that the next one
+    # can be popped off the end; response file contents are pushed in place
+    # of the referencing argument, followed by a None marking the end of the
+    # response file.
+    pendingArgs = list(reversed(cmdline))
+    responseFileChain = []
+    while pendingArgs:
+        arg = pendingArgs.pop()
+        if arg is None:
+            responseFileChain.pop()
+        elif arg[0] == '@':
             includeFile = arg[1:]
-            f = codecs.open(includeFile, 'r', 'utf-16') 
-            includeFileContents = f.read()
-            f.close()
+            includeFilePath = os.path.normcase(os.path.abspath(includeFile))
+            if includeFilePath in responseFileChain:
+                raise ResponseFileCycleError("Response file %s includes itself"
+                                             % includeFile)
+            # Decode the whole file at once rather than through an incremental
+            # decoder; the 'utf-16' codec takes care of the byte order mark.
+            with open(includeFile, 'rb') as f:
+                includeFileContents = f.read().decode('utf-16')
 
             includeFileTokens = includeFileContents.split()
-            ret.extend(expandCommandLine(includeFileTokens))
+            responseFileChain.append(includeFilePath)
+            pendingArgs.append(None)
+            pendingArgs.extend(reversed(includeFileTokens))
         else:
             ret.append(arg)
 
     return ret
 
+# The switches analyzeCommandLine() cares about, looked up by the complete
+# argument or else by the two characters following the '/' or '-'.
+_analyzedSwitches = {"/link": "link", "-link": "link",
+                     "/c": "compileOnly", "-c": "compileOnly"}
+_analyzedSwitchPrefixes = {"Fo": "outputFile",
+                           "Tp": "sourceFile", "Tc": "sourceFile"}
+
 def analyzeCommandLine(cmdline):
     foundCompileOnlySwitch = False
     sourceFile = None
     outputFile = None
     for arg in cmdline[1:]:
-        if arg[0] == '/' or arg[0] == '-':
-            if arg[1:] == 'link':
-                return AnalysisResult.CalledForLink, None, None
-            elif arg[1] == 'c':
-                foundCompileOnlySwitch = True
-            elif arg[1:3] == 'Fo':
-                outputFile = arg[3:]
-            elif arg[1:3] in ('Tp', 'Tc'):
-                sourceFile = arg[3:]
+        switch = _analyzedSwitches.get(arg)
+        if switch is None and arg[0] in "/-":
+            switch = _analyzedSwitchPrefixes.get(arg[1:3])
+
+        if switch == "link":
+            return AnalysisResult.CalledForLink, None, None
+        elif switch == "compileOnly":
+            foundCompileOnlySwitch = True
+        elif switch == "outputFile":
+            outputFile = arg[3:]
+        elif switch == "sourceFile":
+            sourceFile = arg[3:]
+        elif arg[0] in "/-":
+            pass
         elif arg[0] == '@':
             # shouldn't happen!
             return AnalysisResult.MultipleSourceFiles, None, None
@@ -299,23 +784,68 @@ def analyzeCommandLine(cmdline):
     return AnalysisResult.Ok, sourceFile, outputFile
 
 
+def preprocessedSourceCommandLine(cmdLine, sourceFile, preprocessedSourceFile):
+    # Returns the command line for compiling the preprocessed source code
+    # instead of sourceFile, or None if the original source file has to be
+    # compiled.
+    # Precompiled headers need the #include directives, /showIncludes would
+    # not list anything and the remaining switches make the compiler
+    # preprocess only.
+    for arg in cmdLine:
+        if arg[:1] in "/-" and (arg[1:3] in ("Yc", "Yu") or
+                                arg[1:] in ("showIncludes", "E", "EP", "P")):
+            return None
+
+    ret = []
+    for arg in cmdLine:
+        if arg == sourceFile:
+            ret.append(preprocessedSourceFile)
+        elif arg[:1] in "/-" and arg[1:3] in ('Tp', 'Tc') and arg[3:] == sourceFile:
+            ret.append(arg[:3] + preprocessedSourceFile)
+        elif arg[:1] in "/-" and arg[1:3] == 'FI':
+            # The forced includes are contained in the preprocessed source code
+            # already.
+            continue
+        else:
+            ret.append(arg)
+
+    # The expanded command line might exceed the limit of what can be passed
+    # to CreateProcess(), which is what response files are used for.
+    if len(subprocess.list2cmdline(ret)) > 30000:
+        return None
+    return ret
+
 def invokeRealCompiler(compilerBinary, cmdLine, captureOutput=False):
     realCmdline = [compilerBinary] + cmdLine
 
     returnCode = None
     output = None
     if captureOutput:
-        compilerProcess = Popen(realCmdline, stdout=PIPE, stderr=STDOUT)
+        # Python 2 defaults to an unbuffered pipe; read the compiler output
+        # through a fully buffered one instead.
+        compilerProcess = Popen(realCmdline, stdout=PIPE, stderr=STDOUT,
+                                bufsize=-1)
         output = compilerProcess.communicate()[0]
         returnCode = compilerProcess.returncode
     else:
         returnCode = subprocess.call(realCmdline)
     return returnCode, output
 
+def openStore(cache):
+    return PersistentStore(os.path.join(cache.cacheDirectory(), "state.pkl"))
+
 def printStatistics():
     cache = ObjectCache()
-    stats = CacheStatistics(cache)
-    cfg = Configuration(cache)
+    store = openStore(cache)
+    stats = CacheStatistics(cache, store)
+    cfg = Configuration(cache, store)
+    try:
+        with globalCacheLock(cache):
+            cache.updateIndex(stats.foldCacheHits())
+    except FileLockException:
+        # The hit log stays in place; it is folded the next time around.
+        pass
+    store.save()
     print """clcache statistics:
   current cache dir        : %s
   cache size               : %d bytes
@@ -336,6 +866,105 @@ def printStatistics():
        stats.numCallsWithoutSourceFile(),
        stats.numCallsWithMultipleSourceFiles())
 
+def processCompileRequest(compiler, cmdLine, cache, stats, cfg):
+    analysisResult, sourceFile, outputFile = analyzeCommandLine(cmdLine)
+
+    if analysisResult != AnalysisResult.Ok:
+        if analysisResult == AnalysisResult.NoSourceFile:
+            printTraceStatement("Cannot cache invocation as %s: no source file found" % (' '.join(cmdLine)) )
+            stats.registerCallWithoutSourceFile()
+        elif analysisResult == AnalysisResult.MultipleSourceFiles:
+            printTraceStatement("Cannot cache invocation as %s: multiple source files found" % (' '.join(cmdLine)) )
+            stats.registerCallWithMultipleSourceFiles()
+        elif analysisResult == AnalysisResult.CalledForLink or \
+             analysisResult == AnalysisResult.NoCompileOnly:
+            printTraceStatement("Cannot cache invocation as %s: called for linking" % (' '.join(cmdLine)) )
+            stats.registerCallForLinking()
+        return invokeRealCompiler(compiler, sys.argv[1:])[0]
+
+    # The preprocessed source code keeps the name of the source file so that
+    # the compiler's output and the default object file name are unaffected.
+    tempDir = cache.temporaryDirectory()
+    preprocessedSourceFile = os.path.join(tempDir, os.path.basename(sourceFile))
+    try:
+        return processCacheableCompileRequest(compiler, cmdLine, cache, stats,
+                                              cfg, sourceFile, outputFile,
+                                              preprocessedSourceFile)
+    finally:
+        rmtree(tempDir, ignore_errors=True)
+
+def processCacheableCompileRequest(compiler, cmdLine, cache, stats, cfg,
+                                   sourceFile, outputFile, preprocessedSourceFile):
+    cachekey, preprocessedSourceCompilable = cache.computeKey(compiler, cmdLine,
+                                                              preprocessedSourceFile)
+    if cachekey and cache.hasEntry(cachekey):
+        stats.registerCacheHitFast(cachekey)
+        printTraceStatement("Reusing cached object for key " + cachekey + " for " +
+                            "output file " + outputFile)
+        copyOrLink(cache.cachedObjectName(cachekey), outputFile)
+        # A hard link shares the modification time of the cache entry, which
+        # would make the object file look older than its sources.
+        os.utime(outputFile, None)
+        if stats.hitLogSize() > maximumLogSize:
+            # Builds without any cache misses would otherwise never fold the
+            # hit log. Don't hold up the hit if someone else is at it already.
+            try:
+                with globalCacheLock(cache, timeout=0):
+                    cache.updateIndex(stats.foldCacheHits())
+            except FileLockException:
+                pass
+            except Exception as e:
+                printTraceStatement("Failed to fold the cache hit log: %s" % e)
+        cache.printCachedCompilerOutput(cachekey)
+        return 0
+
+    stats.registerCacheMiss()
+
+    # The object file might be a hard link to a cache entry left behind by an
+    # earlier cache hit, and the compiler overwrites it in place.
+    try:
+        if os.stat(outputFile).st_nlink > 1:
+            os.remove(outputFile)
+    except OSError:
+        pass
+
+    preprocessedCmdLine = None
+    if preprocessedSourceCompilable:
+        preprocessedCmdLine = preprocessedSourceCommandLine(cmdLine, sourceFile,
+                                                            preprocessedSourceFile)
+    if preprocessedCmdLine:
+        compilerCmdLine = preprocessedCmdLine
+    else:
+        printTraceStatement("Compiling " + sourceFile + " without reusing " +
+                            "the preprocessed source code")
+        compilerCmdLine = sys.argv[1:]
+
+    returnCode, compilerOutput = invokeRealCompiler(compiler, compilerCmdLine, captureOutput=True)
+    if returnCode == 0 and cachekey:
+        printTraceStatement("Adding file " + outputFile + " to cache using " +
+                            "key " + cachekey)
+        if cache.setEntry(cachekey, outputFile, compilerOutput):
+            stats.registerCacheEntry(os.path.getsize(outputFile))
+        try:
+            # Only serialize on the cache lock if there is anything to clean.
+            if stats.currentCacheSize() >= cfg.maximumCacheSize():
+                with globalCacheLock(cache):
+                    cache.clean(stats, cfg.maximumCacheSize())
+            elif max(stats.hitLogSize(), cache.indexLogSize()) > maximumLogSize:
+                # Otherwise the logs would only be folded once the cache
+                # gets full, growing without bounds until then.
+                with globalCacheLock(cache):
+                    cache.updateIndex(stats.foldCacheHits())
+        except FileLockException:
+            printTraceStatement("Timed out waiting for cache lock while " +
+                                "cleaning the cache")
+        except Exception as e:
+            # The object file was compiled successfully; failing to clean the
+            # cache must not turn that into a failed compile.
+            printTraceStatement("Failed to clean the cache: %s" % e)
+    sys.stdout.write(compilerOutput)
+    return returnCode
+
 if len(sys.argv) == 2 and sys.argv[1] == "--help":
     print """\
 clcache.py v0.1"
@@ -351,12 +980,14 @@ if len(sys.argv) == 2 and sys.argv[1] == "-s":
 
 if len(sys.argv) == 3 and sys.argv[1] == "-M":
     cache = ObjectCache()
-    cfg = Configuration(cache)
+    store = openStore(cache)
+    cfg = Configuration(cache, store)
     cfg.setMaximumCacheSize(int(sys.argv[2]))
-    cfg.save()
+    store.save()
     sys.exit(0)
 
-compiler = findCompilerBinary()
+cache = ObjectCache()
+compiler = findCompilerBinary(cache)
 if not compiler:
     print "Failed to locate cl.exe on PATH (and CLCACHE_CL is not set), aborting."
     sys.exit(1)
@@ -364,45 +995,15 @@ if not compiler:
 if "CLCACHE_DISABLE" in os.environ:
     sys.exit(invokeRealCompiler(compiler, sys.argv[1:])[0])
    
-cmdLine = expandCommandLine(sys.argv[1:])
-analysisResult, sourceFile, outputFile = analyzeCommandLine(cmdLine)
-
-cache = ObjectCache()
-stats = CacheStatistics(cache)
-lock = cacheLock(cache)
-if analysisResult != AnalysisResult.Ok:
-    if analysisResult == AnalysisResult.NoSourceFile:
-        printTraceStatement("Cannot cache invocation as %s: no source file found" % (' '.join(cmdLine)) )
-        stats.registerCallWithoutSourceFile()
-    elif analysisResult == AnalysisResult.MultipleSourceFiles:
-        printTraceStatement("Cannot cache invocation as %s: multiple source files found" % (' '.join(cmdLine)) )
-        stats.registerCallWithMultipleSourceFiles()
-    elif analysisResult == AnalysisResult.CalledForLink or \
-         analysisResult == AnalysisResult.NoCompileOnly:
-        printTraceStatement("Cannot cache invocation as %s: called for linking" % (' '.join(cmdLine)) )
-        stats.registerCallForLinking()
-    stats.save()
-    sys.exit(invokeRealCompiler(compiler, sys.argv[1:])[0])
+try:
+    cmdLine = expandCommandLine(sys.argv[1:])
+except ResponseFileCycleError as e:
+    print "%s, aborting." % e
+    sys.exit(1)
 
-cachekey = cache.computeKey(compiler, cmdLine)
-if cache.hasEntry(cachekey):
-    stats.registerCacheHit()
-    stats.save()
-    printTraceStatement("Reusing cached object for key " + cachekey + " for " +
-                        "output file " + outputFile)
-    copyfile(cache.cachedObjectName(cachekey), outputFile)
-    sys.stdout.write(cache.cachedCompilerOutput(cachekey))
-    sys.exit(0)
-else:
-    stats.registerCacheMiss()
-    returnCode, compilerOutput = invokeRealCompiler(compiler, sys.argv[1:], captureOutput=True)
-    if returnCode == 0:
-        printTraceStatement("Adding file " + outputFile + " to cache using " +
-                            "key " + cachekey)
-        cache.setEntry(cachekey, outputFile, compilerOutput)
-        stats.registerCacheEntry(os.path.getsize(outputFile))
-        cfg = Configuration(cache)
-        cache.clean(stats, cfg.maximumCacheSize())
-    stats.save()
-    sys.stdout.write(compilerOutput)
-    sys.exit(returnCode)
+store = openStore(cache)
+stats = CacheStatistics(cache, store)
+cfg = Configuration(cache, store)
+exitCode = processCompileRequest(compiler, cmdLine, cache, stats, cfg)
+store.save()
+sys.exit(exitCode)